@@ -1,15 +1,14 @@
-import json
 import uuid
-import pandas as pd
-import requests
+import orjson
+import openpyxl
+import httpx
 import logging
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from itertools import islice
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import os
+import gc
 import time
-import numpy as np 
+import random
 
 # Configuration file for default values and API tokens.
 CONFIG_FILE = 'config.json'
@@ -31,8 +30,8 @@ def load_config(config_file):
     :param config_file: Path to the configuration file.
     :return: Dictionary with configuration values.
     """
-    with open(config_file, 'r') as f:
-        return json.load(f)
+    with open(config_file, 'rb') as f:
+        return orjson.loads(f.read())
 
 def get_api_token(config, user_value):
     """
@@ -48,92 +47,219 @@ def get_api_token(config, user_value):
         raise ValueError(f'Unknown user value: {user_value}')
     return token_key
 
-def send_request_with_retry(endpoint, headers, payload, max_retries=3, backoff_factor=0.3):
+# Retry policy for submissions; statuses worth retrying after a backoff.
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 1.0
+BACKOFF_MAX = 30
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+def backoff_delay(attempt):
     """
-    Sends a POST request with retry mechanism on failure.
-    
+    Returns the jittered exponential delay before retry number `attempt`, so
+    concurrent workers that hit the same server error do not all retransmit
+    in lockstep.
+
+    :param attempt: Zero-based retry attempt number.
+    :return: Delay in seconds.
+    """
+    return min(BACKOFF_MAX, BACKOFF_FACTOR * (2 ** attempt)) * (1 + random.random() * 0.5)
+
+def make_client(concurrency):
+    """
+    Creates the shared HTTP/2 client, sized so concurrent submissions can
+    multiplex over the pool without discarding keep-alive connections.
+
+    :param concurrency: Number of worker threads sharing the client.
+    :return: Configured httpx.Client.
+    """
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return httpx.Client(http2=True, limits=limits)
+
+def send_request_with_retry(client, endpoint, headers, body):
+    """
+    Sends a POST request through the shared client, retrying with jittered
+    backoff on server errors and connection failures.
+
+    :param client: Shared httpx.Client owned by the caller.
     :param endpoint: URL endpoint for the POST request.
     :param headers: Request headers.
-    :param payload: JSON payload for the POST request.
-    :param max_retries: Maximum number of retries on failure.
-    :param backoff_factor: Backoff factor for retries.
-    :return: Response object or None if request fails.
-    """
-    session = requests.Session()
-    retries = Retry(
-        total=max_retries,
-        backoff_factor=backoff_factor,
-        status_forcelist=[500, 502, 503, 504],
-        allowed_methods=frozenset(['POST'])  
-    )
-    session.mount('https://', HTTPAdapter(max_retries=retries))
+    :param body: Pre-encoded JSON request body as bytes.
+    :return: Response object or None if the request never succeeded.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = client.post(endpoint, headers=headers, content=body)
+            if response.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                time.sleep(max(backoff_delay(attempt), retry_after_seconds(response)))
+                continue
+            return response
+        except httpx.HTTPError as e:
+            if attempt < MAX_RETRIES:
+                time.sleep(backoff_delay(attempt))
+                continue
+            logging.error(f'Request failed: {e}')
+            return None
+    return None
+
+def retry_after_seconds(response):
+    """
+    Reads a Retry-After header as seconds.
+
+    :param response: Response object from a failed submission.
+    :return: Requested delay in seconds, or 0 when absent or not numeric.
+    """
     try:
-        response = session.post(endpoint, headers=headers, json=payload)
-        return response
-    except requests.RequestException as e:
-        logging.error(f'Request failed: {e}')
-        return None
+        return float(response.headers.get('Retry-After', 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+# Columns read from the spreadsheet when building a submission payload.
+FIELDS = ['Process_Status', 'Reception_ID', 'Full_Name', 'Sex', 'Date_of_Birth',
+          'Arrival_Date', 'Ethnicity', 'Group_Size', 'Reception_Location']
 
-def safe_str(value):
+# Constant portion of every submission, built once instead of per row.
+SUBMISSION_TEMPLATE = {
+    "formhub": {"uuid": "6c18862e8a0442f5b04e957541bb223d"}, #To update
+    "__version__": "vHgTnHiEdARTknHYRTLR2x",#To update
+}
+# The template pre-serialized to a JSON fragment (outer braces stripped),
+# spliced into every request body instead of being re-encoded per row.
+TEMPLATE_FRAGMENT = orjson.dumps(SUBMISSION_TEMPLATE)[1:-1]
+
+def make_body_prefix(project_uuid):
     """
-    Converts a value to a string, handling NaN values.
-    
-    :param value: The value to convert.
-    :return: String representation of the value or empty string if NaN.
+    Builds the constant byte prefix shared by every request body: the project
+    id plus the pre-serialized template fields.
+
+    :param project_uuid: UUID for the project, included in every payload.
+    :return: Leading bytes of the JSON request body.
     """
-    if pd.isna(value):
-        return ''
-    return str(value)
+    return b'{"id":' + orjson.dumps(project_uuid) + b',"submission":{' + TEMPLATE_FRAGMENT + b','
 
-def create_payload(parent_row, project_uuid):
+def encode_payload(record, prefix):
     """
-    Creates a payload for the API request from a row of data.
-    
-    :param parent_row: A pandas Series representing a row of the dataframe.
-    :param project_uuid: UUID for the project, included in the payload.
-    :return: A dictionary representing the JSON payload for the request.
-    """
-    payload = {
-        "id": project_uuid,
-        "submission": {
-            "formhub": {"uuid": "6c18862e8a0442f5b04e957541bb223d"}, #To update
-            "Process_Status": safe_str(parent_row['Process_Status']),
-            "Reception_ID": safe_str(parent_row['Reception_ID']),
-            "Full_Name": safe_str(parent_row['Full_Name']),
-            "Sex": safe_str(parent_row['Sex']),
-            "Date_of_Birth": safe_str(parent_row['Date_of_Birth']),
-            "Arrival_Date": safe_str(parent_row['Arrival_Date']),
-            "Ethnicity": safe_str(parent_row['Ethnicity']),
-            "Group_Size": safe_str(parent_row['Group_Size']),
-            "Reception_Location": safe_str(parent_row['Reception_Location']),
-            
-            "__version__": "vHgTnHiEdARTknHYRTLR2x",#To update
-            
-            "meta": {"instanceID": f"uuid:{safe_str(uuid.uuid4())}"}
-        }
-    }
-    return payload
-
-def process_batch(batch_df, config, endpoint, headers):
+    Encodes one submission to JSON bytes by appending the dynamic row fields
+    to the pre-serialized constant prefix.
+
+    :param record: A plain dict holding one row's field values.
+    :param prefix: Constant body prefix from make_body_prefix.
+    :return: Complete request body as bytes.
+    """
+    dynamic = orjson.dumps({**record, "meta": {"instanceID": "uuid:" + uuid.uuid4().hex}})
+    return prefix + dynamic[1:] + b'}'
+
+def encode_bulk_body(records, prefix):
+    """
+    Encodes a whole batch as one JSON array body for a bulk submission.
+
+    :param records: List of payload-ready dicts.
+    :param prefix: Constant body prefix from make_body_prefix.
+    :return: Request body as bytes.
+    """
+    return b'[' + b','.join(encode_payload(record, prefix) for record in records) + b']'
+
+# Whether the endpoint accepts an array of submissions in one POST. Unknown
+# until the first batch; a 4xx on the bulk attempt disables it for the run.
+BULK_SUPPORTED = None
+
+def read_rows(path):
+    """
+    Opens the Excel file for streaming and yields its rows incrementally.
+
+    :param path: Path to the submission spreadsheet.
+    :return: Tuple of (header row, iterator over the remaining rows as tuples).
+    """
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    ws = wb.active
+    rows_iter = ws.iter_rows(values_only=True)
+    header = next(rows_iter)
+    return header, rows_iter
+
+def batches(rows_iter, n):
+    """
+    Yields successive lists of up to n rows from a streaming row iterator,
+    so only one batch window is ever resident in memory.
+
+    :param rows_iter: Iterator over spreadsheet rows.
+    :param n: Number of rows per batch.
+    """
+    while True:
+        chunk = list(islice(rows_iter, n))
+        if not chunk:
+            return
+        yield chunk
+
+def make_records(chunk, columns):
+    """
+    Converts raw spreadsheet rows into payload-ready dicts, substituting ''
+    for empty cells.
+
+    :param chunk: List of row tuples from the streaming reader.
+    :param columns: Column index for each field in FIELDS.
+    :return: List of dicts keyed by field name.
+    """
+    return [
+        {field: '' if row[i] is None else str(row[i]) for field, i in zip(FIELDS, columns)}
+        for row in chunk
+    ]
+
+def process_batch(records, prefix, endpoint, headers, executor, client):
     """
     Processes a batch of data by sending parallel requests to the API.
-    
-    :param batch_df: DataFrame slice representing the batch to process.
-    :param config: Configuration dictionary.
+
+    :param records: List of payload-ready dicts representing the batch.
+    :param prefix: Constant body prefix from make_body_prefix.
     :param endpoint: API endpoint for the data submission.
     :param headers: Headers to include in the request.
+    :param executor: Shared ThreadPoolExecutor owned by the caller.
+    :param client: Shared httpx.Client owned by the caller.
+    :return: Tuple of (throttle-worthy failure count, largest Retry-After seen).
     """
-    with ThreadPoolExecutor(max_workers=config['concurrency_level']) as executor:
-        future_to_row = {
-            executor.submit(send_request_with_retry, endpoint, headers, create_payload(row, config['project_uuid'])): row
-            for _, row in batch_df.iterrows()
-        }
-        for future in as_completed(future_to_row):
-            response = future.result()
-            if response and response.status_code == 201:
-                logging.info('Submission success')
+    global BULK_SUPPORTED
+    # One POST for the whole batch cuts request count K-fold when the server
+    # accepts it; RTT dominates this pipeline, so try bulk before per-row.
+    if BULK_SUPPORTED is not False:
+        response = send_request_with_retry(client, endpoint, headers, encode_bulk_body(records, prefix))
+        status = response.status_code if response is not None else None
+        if status in (200, 201, 202):
+            BULK_SUPPORTED = True
+            logging.info(f'Bulk submission success ({len(records)} rows)')
+            return 0, 0.0
+        if status in (400, 404, 405):
+            BULK_SUPPORTED = False
+            logging.info('Bulk submission unsupported; falling back to per-row')
+        else:
+            # The server may have ingested the array body before failing, so
+            # resubmitting per-row risks duplicates: count the batch as
+            # failed instead. A failed probe also disables bulk so later
+            # batches do not pay the bulk retry ladder before submitting.
+            if BULK_SUPPORTED is None:
+                BULK_SUPPORTED = False
+                logging.error('Bulk submission probe failed; disabling bulk')
             else:
-                logging.error('Submission failed')
+                logging.error('Bulk submission failed')
+            return len(records), retry_after_seconds(response) if response is not None else 0.0
+
+    failures = 0
+    retry_after = 0.0
+    futures = [
+        executor.submit(send_request_with_retry, client, endpoint, headers, encode_payload(record, prefix))
+        for record in records
+    ]
+    for future in as_completed(futures):
+        response = future.result()
+        if response is not None and response.status_code == 201:
+            logging.info('Submission success')
+        else:
+            logging.error('Submission failed')
+            # Only throttle-worthy outcomes (429/5xx/connection failure) feed
+            # the pacing loop; a permanently invalid row earning a 400 must
+            # not pin the inter-batch sleep at its maximum.
+            if response is None or response.status_code == 429 or response.status_code >= 500:
+                failures += 1
+                if response is not None:
+                    retry_after = max(retry_after, retry_after_seconds(response))
+    return failures, retry_after
 
 def main():
     """
@@ -141,15 +267,46 @@ def main():
     """
     configure_logging()
     config = load_config(CONFIG_FILE)
-    
-    df_root = pd.read_excel(config['parent_data_path'])
+
     endpoint = 'https://kobocat.unhcr.org/api/v1/submissions'
     api_token = get_api_token(config, 'unhcr_prod')
     headers = {'Authorization': f"Token {api_token}", 'Content-Type': 'application/json'}
-    
-    for _, batch_df in tqdm(df_root.groupby(np.arange(len(df_root)) // config['batch_size']), desc="Processing batches"):
-        process_batch(batch_df, config, endpoint, headers)
-        time.sleep(config.get('dynamic_sleep_interval', 5))  # Adjust dynamically based on feedback
+
+    # Stream the workbook instead of loading it whole, so memory stays at
+    # one batch and the first submission starts immediately.
+    header, rows_iter = read_rows(config['parent_data_path'])
+    columns = [header.index(field) for field in FIELDS]
+    required_idx = header.index('Reception_ID')
+    prefix = make_body_prefix(config['project_uuid'])
+    dropped = 0
+
+    # Adaptive pacing: back off multiplicatively while batches fail, creep
+    # back toward zero sleep while the server keeps answering 201.
+    base_sleep = config.get('dynamic_sleep_interval', 5)
+    max_sleep = config.get('max_sleep_interval', 60)
+    sleep = base_sleep
+    # One client and one executor for the whole run: spawning fresh pools per
+    # batch paid startup costs and dropped connection state between windows.
+    with make_client(config['concurrency_level']) as client, \
+         ThreadPoolExecutor(max_workers=config['concurrency_level']) as executor:
+        for chunk in tqdm(batches(rows_iter, config['batch_size']), desc="Processing batches"):
+            # Rows without a Reception_ID would only earn a 400 from the
+            # server; drop them before they cost a round trip.
+            rows = [row for row in chunk if row[required_idx] not in (None, '')]
+            dropped += len(chunk) - len(rows)
+            if not rows:
+                continue
+            failures, retry_after = process_batch(make_records(rows, columns), prefix, endpoint, headers, executor, client)
+            gc.collect()  # release the flushed batch before the next window
+            if failures:
+                sleep = min(max_sleep, max(sleep, base_sleep) * 2)
+            else:
+                sleep = max(0, sleep - 1)
+            if sleep or retry_after:
+                time.sleep(max(sleep, retry_after))
+
+    if dropped:
+        logging.info(f'Dropped {dropped} rows with no Reception_ID')
 
 if __name__ == '__main__':
     main()